@@ -33,26 +33,426 @@ You can plug in compression:
 See also readme: https://github.com/messa/blockcopy
 '''
 
-from argparse import ArgumentParser
-from concurrent.futures import ThreadPoolExecutor
+from argparse import ArgumentParser, ArgumentTypeError
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+import errno
+from functools import partial
 import hashlib
+import json
 from logging import getLogger
+import mmap
+import multiprocessing
 import os
-from queue import Queue
+import shutil
+from struct import Struct
+import stat
 import sys
-from threading import Event
+import time
+import zlib
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
 
 logger = getLogger(__name__)
 
+# Default block size; can be changed using checksum --block-size
 block_size = 128 * 1024
-hash_factory = hashlib.sha3_512
-hash_digest_size = hash_factory().digest_size
-assert hash_digest_size == 512 / 8
-worker_count = min(os.cpu_count(), 8)
+# Block sizes are sent as 4-byte fields ("hash", "data"), and each batch in progress
+# holds at least one block in memory, so larger blocks are not allowed
+max_block_size = 64 << 20
+batch_block_count = 16
+# Maximum length of a batch (unless a single block is larger), regardless of the block size,
+# so the memory used by the batches in progress does not depend on the block size
+batch_size = block_size * batch_block_count
+stream_buffer_size = 1024 * 1024
+# Files modified less than this number of seconds ago are not stored in the hash
+# cache, because another modification within the same file system timestamp
+# tick would not change the mtime
+hash_cache_min_age = 2
+# O_DIRECT reads must be aligned (position, length and buffer address) to the
+# logical block size of the device; page size is safe for all common devices
+direct_io_alignment = mmap.PAGESIZE
+# Number of hash worker threads; they also read the file, so more workers
+# means more reads in flight too. With a fast hash (sha256 on a CPU with SHA
+# extensions, crc32+sha256) fewer workers are enough to saturate the disk or
+# network and leave CPU for ssh/compression - use --workers to lower it.
+default_worker_count = min(os.cpu_count(), 8)
+
+
+class Crc32PrefixedHash:
+    '''
+    Hash object with the same interface as the hashlib hash objects.
+    The digest is crc32 of the data followed by the digest of another hash.
+
+    Retrieve compares the crc32 part first (see hash_blocks_to_compare) and
+    computes the other hash only for blocks whose crc32 matches, so changed
+    blocks are detected at crc32 speed.
+    '''
+
+    crc_fields = Struct('>I')
+    crc_size = crc_fields.size
+
+    def __init__(self, hash_factory, data=b''):
+        self.crc = zlib.crc32(data)
+        self.hash = hash_factory(data)
+        self.digest_size = self.crc_size + self.hash.digest_size
+
+    def digest(self):
+        return self.crc_fields.pack(self.crc) + self.hash.digest()
+
+    @classmethod
+    def is_factory(cls, hash_factory):
+        '''
+        Return True if the digests of hash_factory start with crc32 - also when
+        truncated by TruncatedHash (min_digest_size leaves the crc32 part whole).
+        '''
+        if isinstance(hash_factory, partial) and hash_factory.func is TruncatedHash:
+            hash_factory = hash_factory.args[0]
+        return isinstance(hash_factory, partial) and hash_factory.func is cls
+
+
+class TruncatedHash:
+    '''
+    Hash object with the same interface as the hashlib hash objects.
+    The digest is the first digest_size bytes of the digest of another hash.
+
+    Shorter digests make the hash stream smaller; 16 bytes are still plenty
+    for telling whether a block has changed.
+    '''
+
+    def __init__(self, hash_factory, digest_size, data=b''):
+        self.hash = hash_factory(data)
+        self.digest_size = digest_size
+
+    def digest(self):
+        return self.hash.digest()[:self.digest_size]
+
+
+hash_algorithms = {
+    'sha3_512': hashlib.sha3_512,
+    'sha256': hashlib.sha256,
+    'blake2b': hashlib.blake2b,
+    'crc32+sha256': partial(Crc32PrefixedHash, hashlib.sha256),
+}
+if blake3 is not None:
+    # SIMD (AVX2, AVX-512, NEON) accelerated, faster than sha256 even with SHA extensions
+    hash_algorithms['blake3'] = blake3.blake3
+if xxhash is not None:
+    # Non-cryptographic, so it only detects accidental changes - do not use it
+    # when someone could craft the file content to produce a collision
+    hash_algorithms['xxh3_128'] = xxhash.xxh3_128
+# SHA-256 is hardware accelerated (SHA-NI, ARMv8 SHA2) on most current CPUs
+default_hash_name = 'sha256'
+
+# Hash streams produced by older versions do not contain the "algo" command
+legacy_hash_name = 'sha3_512'
+
+# Truncated digests shorter than this are not allowed
+min_digest_size = 8
+
+# Fields that follow the 4-byte command in the streams
+digest_size_fields = Struct('>B')  # "dgst": digest size
+hash_fields = Struct('>I')  # "hash": block size; followed by the hash
+data_fields = Struct('>QI')  # "data": block position, block size; followed by the block data
+copy_fields = Struct('>QI')  # "copy": block position, block size; the data are copied from the source file by save
+rest_fields = Struct('>Q')  # "rest": position where the hashed part of the file ends
+
+
+def get_hash_factory(hash_name, digest_size=None):
+    '''
+    Return hash factory for the algorithm name, with digests truncated
+    to digest_size bytes if given.
+    '''
+    try:
+        hash_factory = hash_algorithms[hash_name]
+    except KeyError:
+        raise Exception(f'Unsupported hash algorithm: {hash_name!r}') from None
+    if digest_size is None:
+        return hash_factory
+    full_digest_size = hash_factory().digest_size
+    if not min_digest_size <= digest_size <= full_digest_size:
+        raise Exception(f'Digest size of {hash_name} must be between {min_digest_size} and {full_digest_size}')
+    return partial(TruncatedHash, hash_factory, digest_size)
+
+
+def hash_batch(hash_factory, block_data_batch):
+    '''
+    Return list of hashes (digests) of the given blocks.
+
+    All blocks of a batch are hashed in one call so that the hashing can be
+    replaced by an implementation processing multiple buffers at once.
+
+    The hash objects from hashlib release the GIL while hashing data larger
+    than a few kilobytes, so hash_batch() running in multiple threads uses
+    multiple CPU cores. Passing the data directly to the constructor (instead
+    of calling update()) keeps the Python overhead to one call per block.
+    '''
+    return [hash_factory(block_data).digest() for block_data in block_data_batch]
+
+
+def hash_batch_view(hash_factory, batch_view, block_length):
+    '''
+    Split batch_view into blocks of block_length bytes (the last one may be shorter)
+    and return tuple (block_sizes, block_hashes) of two lists.
+    '''
+    block_data_batch = [
+        batch_view[offset:offset + block_length]
+        for offset in range(0, len(batch_view), block_length)
+    ]
+    return [len(block_data) for block_data in block_data_batch], hash_batch(hash_factory, block_data_batch)
+
+
+def map_ordered(executor, fn, items, max_pending):
+    '''
+    Call fn(*args) in the executor for each args tuple from items and yield
+    the results in the same order.
+
+    Unlike executor.map() it does not consume all items at once - at most
+    max_pending calls are submitted ahead of the result being yielded, so
+    the memory used by the batches in progress is bounded. An exception
+    raised by fn is raised here, when its result is reached.
+    '''
+    pending = deque()
+    try:
+        for args in items:
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+            pending.append(executor.submit(fn, *args))
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+class BufferPool:
+    '''
+    Pool of reusable buffers.
+
+    Reading blocks into buffers from the pool (using readinto) avoids allocating
+    a new buffer for every batch. Buffers are allocated lazily as anonymous
+    mmaps, so they are page aligned and can be used for O_DIRECT reads.
+    The number of buffers is given by the number of batches in progress
+    (see map_ordered).
+
+    Buffers larger than the pool buffer size are allocated outside of the pool
+    and put() just drops them.
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self._free = deque()
+
+    def get(self, size=None):
+        if size is not None and size > self.size:
+            return bytearray(size)
+        try:
+            return self._free.pop()
+        except IndexError:
+            return mmap.mmap(-1, self.size)
+
+    def put(self, buf):
+        if isinstance(buf, mmap.mmap):
+            self._free.append(buf)
+
+
+def map_regular_file(fd, file_size, drop_cache=False):
+    '''
+    Return read-only mmap of the whole file, or None if the file is not a regular file
+    (for example a block device) or is empty.
+
+    Hashing directly from the mapping saves copying the data into a buffer.
+    If drop_cache is true, the file is not mapped without mmap.madvise (Python < 3.8),
+    because the mapped pages could not be dropped from the page cache.
+    '''
+    if not file_size or not stat.S_ISREG(os.fstat(fd).st_mode):
+        return None
+    if drop_cache and not hasattr(mmap.mmap, 'madvise'):
+        return None
+    file_map = mmap.mmap(fd, file_size, access=mmap.ACCESS_READ)
+    if hasattr(file_map, 'madvise'):
+        file_map.madvise(mmap.MADV_SEQUENTIAL)
+    return file_map
+
+
+def advise(fd, advice_name):
+    '''
+    Give the kernel a hint how the file will be accessed, if supported by the platform.
+
+    For example POSIX_FADV_SEQUENTIAL makes Linux use a larger readahead window.
+    '''
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, 0, 0, getattr(os, advice_name))
+        except OSError as e:
+            # for example pipes do not support it
+            logger.debug('posix_fadvise %s failed: %r', advice_name, e)
 
 
-def main():
+def drop_cached_pages(fd, file_map, pos, length):
+    '''
+    Tell the kernel that the given part of the file will not be needed again,
+    so that its pages can be dropped from the page cache.
+
+    Pages mapped in this process (file_map) are not dropped by posix_fadvise,
+    so they are unmapped via madvise first.
+    '''
+    if file_map is not None and hasattr(file_map, 'madvise') and pos % mmap.PAGESIZE == 0 and pos < len(file_map):
+        file_map.madvise(mmap.MADV_DONTNEED, pos, min(length, len(file_map) - pos))
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, pos, length, os.POSIX_FADV_DONTNEED)
+
+
+def open_direct(file):
+    '''
+    Return file descriptor of the file opened with O_DIRECT, or None if the file
+    is not a block device or O_DIRECT is not supported.
+
+    Reading a block device with O_DIRECT bypasses the page cache, so the data
+    are not copied once more and do not evict other data from the cache.
+    Regular files are read via mmap or the page cache instead.
+    '''
+    if not hasattr(os, 'O_DIRECT'):
+        return None
+    try:
+        if not stat.S_ISBLK(os.stat(file).st_mode):
+            return None
+        return os.open(file, os.O_RDONLY | os.O_DIRECT)
+    except OSError as e:
+        logger.debug('Cannot open %s with O_DIRECT: %r', file, e)
+        return None
+
+
+def read_batch(fd, direct_fd, file_map, batch_buffer, batch_pos, batch_length):
+    '''
+    Return memoryview of batch_length bytes of the file at position batch_pos
+    (less at the end of file).
+
+    The data are taken directly from file_map if the file is mapped,
+    otherwise they are read into batch_buffer - using direct_fd if the read
+    can be aligned as O_DIRECT requires.
+    '''
+    if file_map is not None:
+        return memoryview(file_map)[batch_pos:batch_pos + batch_length]
+    batch_view = memoryview(batch_buffer)
+    if direct_fd is not None and isinstance(batch_buffer, mmap.mmap) and batch_pos % direct_io_alignment == 0:
+        aligned_length = -(-batch_length // direct_io_alignment) * direct_io_alignment
+        if aligned_length <= len(batch_view):
+            return batch_view[:min(batch_length, pread_into(direct_fd, batch_view[:aligned_length], batch_pos))]
+    batch_view = batch_view[:batch_length]
+    return batch_view[:pread_into(fd, batch_view, batch_pos)]
+
+
+def pread_into(fd, buf, pos):
+    '''
+    Read data from file position pos into buf.
+
+    Returns number of bytes read, which is less than len(buf) only at the end of file.
+    Does not use (or change) the file descriptor position, so it can be called
+    from multiple threads at once.
+    '''
+    view = memoryview(buf)
+    total = 0
+    while total < len(view):
+        if hasattr(os, 'preadv'):
+            n = os.preadv(fd, [view[total:]], pos + total)
+        else:
+            data = os.pread(fd, len(view) - total, pos + total)
+            n = len(data)
+            view[total:total + n] = data
+        if not n:
+            break
+        total += n
+    return total
+
+
+@contextmanager
+def hash_process_pool(use_processes, worker_count, file, drop_cache):
+    '''
+    Yield ProcessPoolExecutor for hashing the file, or None if use_processes is false.
+
+    In worker processes the hashing is not limited by the GIL at all.
+    The worker processes open the file themselves (see init_hash_process)
+    and read the blocks directly, so no block data are sent between
+    processes - just the batch positions and the results.
+
+    The worker processes are started lazily, by the first submit from a thread
+    of the hash thread pool. Forking a multithreaded process can deadlock the
+    child (and is deprecated since Python 3.12), so they are started
+    by forkserver (or spawn where forkserver is not available).
+    '''
+    if not use_processes:
+        yield None
+        return
+
+    start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    with ProcessPoolExecutor(
+            worker_count, mp_context=multiprocessing.get_context(start_method),
+            initializer=init_hash_process, initargs=(file, drop_cache)) as process_pool:
+        yield process_pool
+
+
+# Set in hash worker processes by init_hash_process()
+process_source = None
+
+
+def init_hash_process(file, drop_cache):
+    global process_source
+    fd = os.open(file, os.O_RDONLY)
+    file_size = os.lseek(fd, 0, os.SEEK_END)
+    process_source = fd, open_direct(file), map_regular_file(fd, file_size, drop_cache), mmap.mmap(-1, batch_size)
+
+
+def read_batch_in_process(batch_pos, batch_length):
+    fd, direct_fd, file_map, batch_buffer = process_source
+    if batch_length > len(batch_buffer):
+        batch_buffer = bytearray(batch_length)
+    return read_batch(fd, direct_fd, file_map, batch_buffer, batch_pos, batch_length)
+
+
+def drop_cached_pages_in_process(batch_pos, batch_length):
+    # The pages mapped in the worker process must be unmapped here,
+    # otherwise posix_fadvise in the main process does not drop them
+    fd, direct_fd, file_map, batch_buffer = process_source
+    drop_cached_pages(fd, file_map, batch_pos, batch_length)
+
+
+def hash_file_batch(hash_factory, batch_pos, batch_length, block_length, drop_cache=False):
+    '''
+    Runs in a hash worker process. Same as hash_batch_view() for the batch at batch_pos.
+    '''
+    hash_results = hash_batch_view(hash_factory, read_batch_in_process(batch_pos, batch_length), block_length)
+    if drop_cache:
+        drop_cached_pages_in_process(batch_pos, batch_length)
+    return hash_results
+
+
+def find_changed_blocks_in_file(hash_factory, batch_pos, batch_length, block_sizes, destination_hashes, drop_cache=False):
+    '''
+    Runs in a hash worker process. Same as find_changed_blocks() for the batch
+    at batch_pos, but returns list of tuples (block_pos, block_size).
+    '''
+    batch_view = read_batch_in_process(batch_pos, batch_length)
+    changed_blocks = [
+        (block_pos, len(block_data))
+        for block_pos, block_data in find_changed_blocks(hash_factory, batch_view, batch_pos, block_sizes, destination_hashes)
+    ]
+    if drop_cache:
+        drop_cached_pages_in_process(batch_pos, batch_length)
+    return changed_blocks
+
+
+def main(argv=None):
     parser = ArgumentParser()
     parser.add_argument('-v', '--verbose', action='store_true')
 
@@ -61,11 +461,39 @@ def main():
     p_retrieve = subparsers.add_parser('retrieve')
     p_save = subparsers.add_parser('save')
 
+    p_checksum.add_argument('--hash', choices=sorted(hash_algorithms), default=default_hash_name)
+    p_checksum.add_argument(
+        '--block-size', type=parse_size, default=block_size,
+        help=f'block size in bytes, suffixes K and M can be used (default: {block_size >> 10}K, max: {max_block_size >> 20}M)')
+    p_checksum.add_argument(
+        '--digest-bytes', type=int, metavar='N',
+        help=f'send only first N bytes of each hash (at least {min_digest_size}) to make the hash stream smaller')
+    p_checksum.add_argument('--hash-cache', metavar='PATH', help='store the hashes in this file and reuse them if the file has not changed')
+    for p in p_checksum, p_retrieve:
+        p.add_argument('--processes', action='store_true', help='compute hashes in worker processes instead of threads')
+        p.add_argument('--workers', type=parse_positive_int, help=f'number of hash workers (default: {default_worker_count})')
+        p.add_argument('--drop-cache', action='store_true', help='drop the file data from page cache after use')
+    p_retrieve.add_argument(
+        '--reflink', action='store_true',
+        help='send only positions of the changed blocks, for save --reflink on the same machine')
+    p_save.add_argument(
+        '--workers', type=parse_positive_int,
+        help=f'number of write workers (default: {default_worker_count}); not used when stdin is a pipe '
+             'on Linux with Python 3.10+ - the blocks are then moved from the pipe by splice one by one')
+    p_save.add_argument(
+        '--reflink', metavar='SOURCE',
+        help='copy blocks sent by retrieve --reflink from this file using copy_file_range (reflink on btrfs, XFS)')
+
     p_checksum.add_argument('file')
     p_retrieve.add_argument('file')
     p_save.add_argument('file')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+
+    if args.command == 'checksum' and args.digest_bytes is not None:
+        full_digest_size = hash_algorithms[args.hash]().digest_size
+        if not min_digest_size <= args.digest_bytes <= full_digest_size:
+            parser.error(f'--digest-bytes for {args.hash} must be between {min_digest_size} and {full_digest_size}')
 
     setup_logging(args.verbose or os.environ.get('DEBUG'))
     logger.debug('Args: %r', args)
@@ -73,17 +501,48 @@ def main():
     ctrl_c_will_terminate_immediately()
 
     if args.command == 'checksum':
-        do_checksum(args.file, sys.stdout.buffer)
+        do_checksum(
+            args.file, open_stdout(), hash_name=args.hash, use_processes=args.processes, worker_count=args.workers,
+            hash_cache_path=args.hash_cache, block_size=args.block_size, drop_cache=args.drop_cache,
+            digest_size=args.digest_bytes)
     elif args.command == 'retrieve':
-        do_retrieve(args.file, sys.stdin.buffer, sys.stdout.buffer)
+        do_retrieve(
+            args.file, open_stdin(), open_stdout(), use_processes=args.processes, worker_count=args.workers,
+            drop_cache=args.drop_cache, reflink=args.reflink)
     elif args.command == 'save':
-        do_save(args.file, sys.stdin.buffer)
+        do_save(args.file, open_stdin(), worker_count=args.workers, reflink_source=args.reflink)
     else:
         raise Exception(f'Not implemented: {args.command}')
 
     logger.debug('Done')
 
 
+def parse_size(value):
+    '''
+    Parse size in bytes with optional suffix K (KiB) or M (MiB), for example "128K".
+    '''
+    multiplier = {'K': 1 << 10, 'M': 1 << 20}.get(value[-1:].upper())
+    try:
+        size = int(value[:-1] if multiplier else value) * (multiplier or 1)
+    except ValueError:
+        raise ArgumentTypeError(f'Invalid size: {value!r}') from None
+    if size <= 0:
+        raise ArgumentTypeError(f'Size must be positive: {value!r}')
+    if size > max_block_size:
+        raise ArgumentTypeError(f'Size must be at most {max_block_size >> 20}M: {value!r}')
+    return size
+
+
+def parse_positive_int(value):
+    try:
+        n = int(value)
+    except ValueError:
+        raise ArgumentTypeError(f'Invalid number: {value!r}') from None
+    if n <= 0:
+        raise ArgumentTypeError(f'Number must be positive: {value!r}')
+    return n
+
+
 def setup_logging(verbose):
     from logging import basicConfig, DEBUG, INFO
     basicConfig(
@@ -91,6 +550,26 @@ def setup_logging(verbose):
         level=DEBUG if verbose else INFO)
 
 
+def open_stdin():
+    '''
+    Return stdin as a binary stream with a larger buffer than sys.stdin.buffer has.
+
+    The streams consist of many small records (command, size, hash...), so
+    a large read-ahead buffer saves a lot of read syscalls.
+    '''
+    return open(sys.stdin.fileno(), 'rb', buffering=stream_buffer_size, closefd=False)
+
+
+def open_stdout():
+    '''
+    Return stdout as a binary stream with a larger buffer than sys.stdout.buffer has.
+
+    Small records (hashes, block headers) are collected in the buffer and
+    written in large chunks instead of a syscall for each of them.
+    '''
+    return open(sys.stdout.fileno(), 'wb', buffering=stream_buffer_size, closefd=False)
+
+
 def ctrl_c_will_terminate_immediately():
     '''
     Make Ctrl+C terminate the process immediately.
@@ -108,97 +587,209 @@ def ctrl_c_will_terminate_immediately():
     signal(SIGTERM, lambda *args: os.kill(os.getpid(), SIGKILL))
 
 
-def do_checksum(file, hash_output_stream):
+def do_checksum(
+        file, hash_output_stream, hash_name=default_hash_name, use_processes=False, worker_count=None,
+        hash_cache_path=None, block_size=block_size, drop_cache=False, digest_size=None):
     '''
     Read the file in blocks, calculate hash of each block and write the hashes to the output stream.
 
     The output stream is a binary stream of the following format:
 
+    - 4 bytes: command "algo"
+    - 1 byte: length of the hash algorithm name
+    - N bytes: hash algorithm name, for example "sha3_512"
+    - 4 bytes: command "dgst" (only if digest_size is given)
+    - 1 byte: digest size - the hashes are truncated to this size
     - 4 bytes: command "hash"
     - 4 bytes: size of the block
-    - 64 bytes: hash of the block
+    - M bytes: hash of the block (M is digest size of the hash algorithm)
     - 4 bytes: command "hash"
     - 4 bytes: size of the block
-    - 64 bytes: hash of the block
+    - M bytes: hash of the block
     - ...
+    - 4 bytes: command "rest"
+    - 8 bytes: size of the file - the other side sends everything after this position
     - 4 bytes: command "done"
+
+    If the file does not exist, no hashes are computed and the whole file is
+    sent by the other side.
+
+    If hash_cache_path is given, the hashes are stored in that file and
+    reused next time if the file (a regular file) has not been modified since.
+
+    If drop_cache is true, the file data are dropped from the page cache
+    after they have been hashed.
     '''
-    with ThreadPoolExecutor(worker_count + 2) as executor:
-        block_queue = Queue(worker_count * 3)
-        send_queue = Queue(worker_count * 3)
-
-        def read_worker():
-            # Only one will run
-            with open(file, 'rb') as f:
-                while True:
-                    block_data_batch = []
-                    for _ in range(16):
-                        block_data = f.read(block_size)
-                        if not block_data:
-                            break
-                        block_data_batch.append(block_data)
-
-                    if not block_data_batch:
-                        break
-
-                    hash_result_event = Event()
-                    hash_result_container = []
-                    block_queue.put((block_data_batch, hash_result_event, hash_result_container))
-                    send_queue.put((hash_result_event, hash_result_container))
-
-            for _ in range(worker_count):
-                block_queue.put(None)
-            send_queue.put(None)
-
-        def hash_worker():
-            # Will run in multiple threads
-            while True:
-                task = block_queue.get()
-                try:
-                    if task is None:
-                        break
-                    block_data_batch, hash_result_event, hash_result_container = task
-                    hash_results = []
-                    for block_data in block_data_batch:
-                        hash_results.append((
-                            len(block_data),
-                            hash_factory(block_data).digest(),
-                        ))
-                    hash_result_container.append(hash_results)
-                    hash_result_event.set()
-                finally:
-                    block_queue.task_done()
-
-        def send_worker():
-            # Only one will run
-            while True:
-                task = send_queue.get()
-                try:
-                    if task is None:
-                        break
-                    hash_result_event, hash_result_container = task
-                    hash_result_event.wait()
-                    hash_results, = hash_result_container
-                    for block_data_length, block_hash in hash_results:
-                        hash_output_stream.write(b'hash')
-                        hash_output_stream.write(block_data_length.to_bytes(4, 'big'))
-                        hash_output_stream.write(block_hash)
-                finally:
-                    send_queue.task_done()
-
-        futures = [
-            executor.submit(read_worker),
-            *[executor.submit(hash_worker) for _ in range(worker_count)],
-            executor.submit(send_worker),
-        ]
-        for f in futures:
-            f.result()
+    worker_count = worker_count or default_worker_count
+    hash_factory = get_hash_factory(hash_name, digest_size)
+    hash_name_b = hash_name.encode('ascii')
+    hash_output_stream.write(b'algo')
+    hash_output_stream.write(len(hash_name_b).to_bytes(1, 'big'))
+    hash_output_stream.write(hash_name_b)
+    if digest_size is not None:
+        hash_output_stream.write(b'dgst' + digest_size_fields.pack(digest_size))
 
+    if not os.path.exists(file):
+        logger.debug('File %s does not exist, the whole file will be retrieved', file)
+        hash_output_stream.write(b'rest' + rest_fields.pack(0))
+        hash_output_stream.write(b'done')
+        hash_output_stream.flush()
+        return
+
+    cache_key = get_hash_cache_key(file, hash_name, digest_size, block_size) if hash_cache_path else None
+    cached_hashes = open_hash_cache(hash_cache_path, cache_key)
+    if cached_hashes is not None:
+        logger.debug('Using hashes from %s', hash_cache_path)
+        with cached_hashes:
+            shutil.copyfileobj(cached_hashes, hash_output_stream, stream_buffer_size)
+        file_size = cache_key['size']
+    else:
+        with hash_cache_writer(hash_cache_path, file, cache_key) as cache_file:
+            file_size = hash_file_blocks(
+                file, hash_factory, block_size, hash_output_stream, cache_file, use_processes, worker_count, drop_cache)
+
+    hash_output_stream.write(b'rest' + rest_fields.pack(file_size))
     hash_output_stream.write(b'done')
     hash_output_stream.flush()
 
 
-def do_retrieve(file, hash_input_stream, block_output_stream):
+def hash_file_blocks(file, hash_factory, block_length, hash_output_stream, cache_file, use_processes, worker_count, drop_cache):
+    '''
+    Write "hash" command for each block of the file to hash_output_stream
+    (and to cache_file, if not None). Returns size of the file.
+    '''
+    hash_digest_size = hash_factory().digest_size
+    fd = os.open(file, os.O_RDONLY)
+    direct_fd = open_direct(file)
+    try:
+        file_size = os.lseek(fd, 0, os.SEEK_END)
+        advise(fd, 'POSIX_FADV_SEQUENTIAL')
+        file_map = map_regular_file(fd, file_size, drop_cache)
+        buffer_pool = BufferPool(batch_size)
+        with hash_process_pool(use_processes, worker_count, file, drop_cache) as process_pool, ThreadPoolExecutor(worker_count) as executor:
+
+            def hash_task(batch_pos, batch_length):
+                # Will run in multiple threads
+                # The reading is done here too, so that multiple reads can run in parallel.
+                if process_pool is not None:
+                    hash_results = process_pool.submit(
+                        hash_file_batch, hash_factory, batch_pos, batch_length, block_length, drop_cache).result()
+                else:
+                    batch_buffer = buffer_pool.get(batch_length) if file_map is None else None
+                    batch_view = read_batch(fd, direct_fd, file_map, batch_buffer, batch_pos, batch_length)
+                    hash_results = hash_batch_view(hash_factory, batch_view, block_length)
+                    del batch_view
+                    if batch_buffer is not None:
+                        buffer_pool.put(batch_buffer)
+                    if drop_cache:
+                        drop_cached_pages(fd, file_map, batch_pos, batch_length)
+                return hash_results
+
+            # Whole blocks per batch, at least one
+            max_batch_length = max(batch_size // block_length, 1) * block_length
+            tasks = (
+                (batch_pos, min(max_batch_length, file_size - batch_pos))
+                for batch_pos in range(0, file_size, max_batch_length))
+            record_size = 4 + hash_fields.size + hash_digest_size
+            hash_offset = 4 + hash_fields.size
+            pack_into = hash_fields.pack_into
+            for block_sizes, block_hashes in map_ordered(executor, hash_task, tasks, worker_count * 2):
+                # Write the whole batch at once
+                output = bytearray(record_size * len(block_sizes))
+                offset = 0
+                for block_data_length, block_hash in zip(block_sizes, block_hashes):
+                    output[offset:offset + 4] = b'hash'
+                    pack_into(output, offset + 4, block_data_length)
+                    output[offset + hash_offset:offset + record_size] = block_hash
+                    offset += record_size
+                hash_output_stream.write(output)
+                if cache_file is not None:
+                    cache_file.write(output)
+
+        if file_map is not None:
+            file_map.close()
+    finally:
+        os.close(fd)
+        if direct_fd is not None:
+            os.close(direct_fd)
+    return file_size
+
+
+def get_hash_cache_key(file, hash_name, digest_size, block_size):
+    '''
+    Return dict identifying the file content for the hash cache, or None if the
+    file cannot be cached.
+
+    Only regular files can be cached - block devices do not update their mtime.
+    ctime is included because it cannot be set back like mtime (touch, rsync -t).
+    '''
+    st = os.stat(file)
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    if time.time_ns() - max(st.st_mtime_ns, st.st_ctime_ns) < hash_cache_min_age * 10**9:
+        return None
+    return {
+        'hash': hash_name,
+        'digest_size': digest_size,
+        'block_size': block_size,
+        'dev': st.st_dev,
+        'ino': st.st_ino,
+        'size': st.st_size,
+        'mtime_ns': st.st_mtime_ns,
+        'ctime_ns': st.st_ctime_ns,
+    }
+
+
+def open_hash_cache(hash_cache_path, cache_key):
+    '''
+    Return the hash cache file positioned at the hash records if it exists
+    and was created for cache_key, otherwise None.
+
+    The hash cache file consists of cache key (JSON) on the first line
+    followed by the "hash" commands as written by do_checksum.
+    '''
+    if cache_key is None:
+        return None
+    try:
+        f = open(hash_cache_path, 'rb')
+    except FileNotFoundError:
+        return None
+    try:
+        if json.loads(f.readline()) == cache_key:
+            return f
+    except ValueError:
+        pass
+    f.close()
+    return None
+
+
+@contextmanager
+def hash_cache_writer(hash_cache_path, file, cache_key):
+    '''
+    Yield file object for writing the hash records to the hash cache, or None
+    if the hash cache is not used.
+
+    The hash cache file is replaced only if the file has not changed
+    while it was being hashed.
+    '''
+    if cache_key is None:
+        yield None
+        return
+    temp_path = f'{hash_cache_path}.tmp-{os.getpid()}'
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(json.dumps(cache_key).encode() + b'\n')
+            yield f
+        if get_hash_cache_key(file, cache_key['hash'], cache_key['digest_size'], cache_key['block_size']) == cache_key:
+            os.replace(temp_path, hash_cache_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+
+
+def do_retrieve(
+        file, hash_input_stream, block_output_stream, use_processes=False, worker_count=None, drop_cache=False,
+        reflink=False):
     '''
     Read the file in blocks, calculate hash of each block, read hash from
     hash_input_stream and if those hashes differ, write the block to
@@ -216,122 +807,454 @@ def do_retrieve(file, hash_input_stream, block_output_stream):
     - N bytes: block data
     - ...
     - 4 bytes: command "done"
+
+    If reflink is true, command "copy" with the same fields, but without
+    the block data, is written instead of "data". The save side then copies
+    the block from the same file - this works only if both sides run on
+    the same machine.
     '''
-    with ThreadPoolExecutor(worker_count + 2) as executor:
-        hash_queue = Queue(worker_count * 3)
-        send_queue = Queue(worker_count * 3)
-
-        def read_worker():
-            # Only one will run
-            with open(file, 'rb') as f:
-                batch = []
-                while True:
-                    command = hash_input_stream.read(4)
-                    if command == b'done':
-                        break
-                    elif command == b'hash':
-                        block_size_b = hash_input_stream.read(4)
-                        destination_hash = hash_input_stream.read(hash_digest_size)
-                        block_size = int.from_bytes(block_size_b, 'big')
-                        assert len(destination_hash) == hash_digest_size
-                        block_pos = f.tell()
-                        block_data = f.read(block_size)
-                        assert block_data
-
-                        batch.append((destination_hash, block_pos, block_data))
-
-                        if len(batch) >= 16:
-                            hash_result_event = Event()
-                            hash_result_container = []
-                            hash_queue.put((batch, hash_result_event, hash_result_container))
-                            send_queue.put((hash_result_event, hash_result_container))
-                            batch = []
-                    else:
-                        raise Exception(f'Unknown command received: {command!r}')
-
-                if batch:
-                    hash_result_event = Event()
-                    hash_result_container = []
-                    hash_queue.put((batch, hash_result_event, hash_result_container))
-                    send_queue.put((hash_result_event, hash_result_container))
-                    del batch
-
-            for _ in range(worker_count):
-                hash_queue.put(None)
-            send_queue.put(None)
-
-        def hash_worker():
-            # Will run in multiple threads
-            while True:
-                task = hash_queue.get()
-                try:
-                    if task is None:
-                        break
-                    batch, hash_result_event, hash_result_container = task
-
-                    to_send = []
-                    for destination_hash, block_pos, block_data in batch:
-                        block_hash = hash_factory(block_data).digest()
-                        if block_hash != destination_hash:
-                            to_send.append((block_pos, block_data))
-
-                    hash_result_container.append(to_send)
-                    hash_result_event.set()
-                finally:
-                    hash_queue.task_done()
-
-        def send_worker():
-            # Only one will run
-            while True:
-                task = send_queue.get()
-                try:
-                    if task is None:
-                        break
-                    hash_result_event, hash_result_container = task
-                    hash_result_event.wait()
-                    to_send, = hash_result_container
-                    for block_pos, block_data in to_send:
-                        block_output_stream.write(b'data')
-                        block_output_stream.write(block_pos.to_bytes(8, 'big'))
-                        block_output_stream.write(len(block_data).to_bytes(4, 'big'))
-                        block_output_stream.write(block_data)
-                finally:
-                    send_queue.task_done()
-
-        futures = [
-            executor.submit(read_worker),
-            *[executor.submit(hash_worker) for _ in range(worker_count)],
-            executor.submit(send_worker),
-        ]
-        for f in futures:
-            f.result()
+    worker_count = worker_count or default_worker_count
+    fd = os.open(file, os.O_RDONLY)
+    direct_fd = open_direct(file)
+    try:
+        advise(fd, 'POSIX_FADV_SEQUENTIAL')
+        file_size = os.lseek(fd, 0, os.SEEK_END)
+        file_map = map_regular_file(fd, file_size, drop_cache)
+        buffer_pool = BufferPool(batch_size)
+        with hash_process_pool(use_processes, worker_count, file, drop_cache) as process_pool, ThreadPoolExecutor(worker_count) as executor:
+
+            def find_changed_blocks_task(hash_factory, batch_pos, batch_length, block_sizes, destination_hashes):
+                # Will run in multiple threads
+                # The reading is done here too, so that multiple reads can run in parallel.
+                batch_buffer = buffer_pool.get(batch_length) if file_map is None else None
+                if process_pool is not None:
+                    changed_blocks = process_pool.submit(
+                        find_changed_blocks_in_file, hash_factory, batch_pos, batch_length, block_sizes,
+                        destination_hashes, drop_cache).result()
+                    to_send = read_changed_blocks(fd, direct_fd, file_map, batch_buffer, batch_pos, batch_length, changed_blocks)
+                else:
+                    batch_view = read_batch(fd, direct_fd, file_map, batch_buffer, batch_pos, batch_length)
+                    to_send = find_changed_blocks(hash_factory, batch_view, batch_pos, block_sizes, destination_hashes)
+                return batch_buffer, batch_pos, batch_length, to_send
+
+            # Data of a mapped file are in the page cache, so the kernel can send them directly
+            sendfile_fd = fd if file_map is not None and is_sendfile_possible(block_output_stream) else None
+            hash_records = read_hash_stream(hash_input_stream, file_size)
+            tasks = batch_hash_records(hash_records, buffer_pool.size)
+            for batch_buffer, batch_pos, batch_length, to_send in map_ordered(
+                    executor, find_changed_blocks_task, tasks, worker_count * 2):
+                if reflink:
+                    write_copy_commands(block_output_stream, to_send)
+                else:
+                    write_data_commands(block_output_stream, to_send, sendfile_fd)
+                # Release the memoryviews of batch_buffer or file_map
+                to_send.clear()
+                if drop_cache:
+                    drop_cached_pages(fd, file_map, batch_pos, batch_length)
+                if batch_buffer is not None:
+                    buffer_pool.put(batch_buffer)
+
+        if file_map is not None:
+            file_map.close()
+    finally:
+        os.close(fd)
+        if direct_fd is not None:
+            os.close(direct_fd)
 
     block_output_stream.write(b'done')
     block_output_stream.flush()
 
 
-def do_save(file, block_input_stream):
+def write_data_commands(block_output_stream, blocks, sendfile_fd=None):
+    '''
+    Write "data" command for each tuple (block_pos, block_data) to block_output_stream.
+
+    If sendfile_fd is not None, the block data are not written from block_data,
+    but sent by os.sendfile from sendfile_fd at block_pos - the kernel copies
+    them to the output without passing them through Python.
+    '''
+    write = block_output_stream.write
+    pack = data_fields.pack
+    for block_pos, block_data in blocks:
+        # Block data are written separately so that they are not copied
+        # into a new bytes object; the stream buffer merges the writes
+        write(b'data' + pack(block_pos, len(block_data)))
+        if sendfile_fd is None:
+            write(block_data)
+        else:
+            block_output_stream.flush()
+            sendfile_exactly(block_output_stream.fileno(), sendfile_fd, block_pos, len(block_data))
+
+
+def write_copy_commands(block_output_stream, blocks):
+    '''
+    Write "copy" command for each tuple (block_pos, block_data) to block_output_stream.
+    '''
+    write = block_output_stream.write
+    pack = copy_fields.pack
+    for block_pos, block_data in blocks:
+        write(b'copy' + pack(block_pos, len(block_data)))
+
+
+def is_sendfile_possible(output_stream):
+    # On other platforms than Linux sendfile works only with sockets
+    if not hasattr(os, 'sendfile') or not sys.platform.startswith('linux'):
+        return False
+    try:
+        output_fd = output_stream.fileno()
+    except (AttributeError, OSError, ValueError):
+        # for example io.BytesIO has no file descriptor
+        return False
+    import fcntl
+    # sendfile fails with EINVAL if the output is opened with O_APPEND (shell >>)
+    return not fcntl.fcntl(output_fd, fcntl.F_GETFL) & os.O_APPEND
+
+
+def sendfile_exactly(output_fd, input_fd, input_pos, size):
+    '''
+    Send size bytes from file input_fd at position input_pos to output_fd.
+    '''
+    while size:
+        n = os.sendfile(output_fd, input_fd, input_pos, size)
+        if not n:
+            raise Exception('Unexpected end of file')
+        input_pos += n
+        size -= n
+
+
+def hash_blocks_to_compare(hash_factory, block_data_batch, destination_hashes):
+    '''
+    Return hashes of the blocks for comparison with destination_hashes.
+
+    For Crc32PrefixedHash the full hash is computed only for blocks with the
+    same crc32 as the destination block; for the other blocks just the crc32
+    is returned, which is enough to tell that the block differs.
+    '''
+    if not Crc32PrefixedHash.is_factory(hash_factory):
+        return hash_batch(hash_factory, block_data_batch)
+
+    crc_size = Crc32PrefixedHash.crc_size
+    pack_crc = Crc32PrefixedHash.crc_fields.pack
+    block_hashes = [pack_crc(zlib.crc32(block_data)) for block_data in block_data_batch]
+    same_crc = [i for i, (crc, h) in enumerate(zip(block_hashes, destination_hashes)) if crc == h[:crc_size]]
+    if same_crc:
+        full_hashes = hash_batch(hash_factory, [block_data_batch[i] for i in same_crc])
+        for i, block_hash in zip(same_crc, full_hashes):
+            block_hashes[i] = block_hash
+    return block_hashes
+
+
+def batch_hash_records(hash_records, max_batch_length):
+    '''
+    Group records from read_hash_stream into batches of up to batch_block_count blocks
+    that have together at most max_batch_length bytes (unless a single
+    block is larger). Blocks without destination hash are not mixed with
+    the other blocks in one batch.
+
+    Yields tuples (hash_factory, batch_pos, batch_length, block_sizes, destination_hashes)
+    where block_sizes and destination_hashes are lists with an item for each block.
+    '''
+    block_sizes = []
+    destination_hashes = []
+    batch_pos = 0
+    batch_length = 0
+    for hash_factory, block_data_size, destination_hash in hash_records:
+        if block_sizes and (
+                len(block_sizes) >= batch_block_count or batch_length + block_data_size > max_batch_length
+                or (destination_hash is None) != (destination_hashes[-1] is None)):
+            yield hash_factory, batch_pos, batch_length, block_sizes, destination_hashes
+            batch_pos += batch_length
+            block_sizes = []
+            destination_hashes = []
+            batch_length = 0
+
+        block_sizes.append(block_data_size)
+        destination_hashes.append(destination_hash)
+        batch_length += block_data_size
+
+    if block_sizes:
+        yield hash_factory, batch_pos, batch_length, block_sizes, destination_hashes
+
+
+def find_changed_blocks(hash_factory, batch_view, batch_pos, block_sizes, destination_hashes):
+    '''
+    Split batch_view (data read from file position batch_pos) into blocks
+    of block_sizes and compare their hashes with destination_hashes received
+    from the other side.
+
+    Returns list of tuples (block_pos, block_data) of the blocks that differ.
+    Blocks without destination hash (None) are always returned.
+    '''
+    block_positions = []
+    block_data_batch = []
+    offset = 0
+    for block_data_size in block_sizes:
+        block_data = batch_view[offset:offset + block_data_size]
+        assert block_data
+        block_positions.append(batch_pos + offset)
+        block_data_batch.append(block_data)
+        offset += block_data_size
+
+    if destination_hashes[0] is None:
+        # The destination does not have these blocks at all (see batch_hash_records)
+        return list(zip(block_positions, block_data_batch))
+
+    block_hashes = hash_blocks_to_compare(hash_factory, block_data_batch, destination_hashes)
+    if b''.join(block_hashes) == b''.join(destination_hashes):
+        # The common case when the files are mostly the same - compare the whole batch at once
+        return []
+
+    return [
+        (block_pos, block_data)
+        for block_pos, block_data, block_hash, destination_hash
+        in zip(block_positions, block_data_batch, block_hashes, destination_hashes)
+        if block_hash != destination_hash
+    ]
+
+
+def read_changed_blocks(fd, direct_fd, file_map, batch_buffer, batch_pos, batch_length, changed_blocks):
+    '''
+    Read the batch at batch_pos (see read_batch) if changed_blocks - list of
+    tuples (block_pos, block_size) - is not empty.
+
+    Returns list of tuples (block_pos, block_data) like find_changed_blocks().
+    '''
+    if not changed_blocks:
+        return []
+    batch_view = read_batch(fd, direct_fd, file_map, batch_buffer, batch_pos, batch_length)
+    return [
+        (block_pos, batch_view[block_pos - batch_pos:block_pos - batch_pos + block_size])
+        for block_pos, block_size in changed_blocks
+    ]
+
+
+def read_hash_stream(hash_input_stream, file_size):
+    '''
+    Parse the stream produced by do_checksum.
+
+    Yields tuples (hash_factory, block_size, block_hash) for every "hash" command.
+    For the "rest" command yields tuples with block_hash None for the blocks
+    from the received position up to file_size (size of the local file).
+    '''
+    hash_name = legacy_hash_name
+    hash_factory = get_hash_factory(hash_name)
+    hash_digest_size = hash_factory().digest_size
+    hash_received = False
+    while True:
+        command = hash_input_stream.read(4)
+        if command == b'done':
+            break
+        elif command == b'algo':
+            if hash_received:
+                raise Exception('Command "algo" received after some hashes')
+            hash_name_length_b = hash_input_stream.read(1)
+            assert len(hash_name_length_b) == 1
+            hash_name_b = hash_input_stream.read(hash_name_length_b[0])
+            assert len(hash_name_b) == hash_name_length_b[0]
+            hash_name = hash_name_b.decode('ascii')
+            logger.debug('Hash algorithm: %s', hash_name)
+            hash_factory = get_hash_factory(hash_name)
+            hash_digest_size = hash_factory().digest_size
+        elif command == b'dgst':
+            if hash_received:
+                raise Exception('Command "dgst" received after some hashes')
+            fields = hash_input_stream.read(digest_size_fields.size)
+            assert len(fields) == digest_size_fields.size
+            digest_size, = digest_size_fields.unpack(fields)
+            logger.debug('Digest size: %s', digest_size)
+            hash_factory = get_hash_factory(hash_name, digest_size)
+            hash_digest_size = digest_size
+        elif command == b'hash':
+            record = hash_input_stream.read(hash_fields.size + hash_digest_size)
+            assert len(record) == hash_fields.size + hash_digest_size
+            block_data_size, = hash_fields.unpack_from(record)
+            block_hash = record[hash_fields.size:]
+            hash_received = True
+            yield hash_factory, block_data_size, block_hash
+        elif command == b'rest':
+            fields = hash_input_stream.read(rest_fields.size)
+            assert len(fields) == rest_fields.size
+            rest_pos, = rest_fields.unpack(fields)
+            for block_pos in range(rest_pos, file_size, block_size):
+                yield hash_factory, min(block_size, file_size - block_pos), None
+        else:
+            raise Exception(f'Unknown command received: {command!r}')
+
+
+def do_save(file, block_input_stream, worker_count=None, reflink_source=None):
     '''
     Read blocks from block_input_stream and write them to the file.
+    The file is created if it does not exist.
+
+    Blocks sent as "copy" commands (retrieve with reflink) are copied from
+    the file reflink_source using os.copy_file_range - on filesystems like
+    btrfs or XFS the destination then shares the extents with the source
+    instead of writing the data again.
+
+    If the input is a pipe and os.splice is available (Linux, Python 3.10+),
+    the block data are moved from the pipe to the file by the kernel without
+    copying them through Python. In that case the input is read directly via
+    its file descriptor, so nothing must have been read from the stream before.
+
+    Otherwise the blocks are written by multiple threads using os.pwrite,
+    so that more writes can be in flight on the device at once.
     '''
-    with open(file, 'r+b') as f:
-        while True:
-            command = block_input_stream.read(4)
-            if not command:
-                break
-            if command == b'done':
-                break
-            elif command == b'data':
-                block_pos_b = block_input_stream.read(8)
-                block_size_b = block_input_stream.read(4)
-                block_pos = int.from_bytes(block_pos_b, 'big')
-                block_size = int.from_bytes(block_size_b, 'big')
-                block_data = block_input_stream.read(block_size)
-                assert len(block_data) == block_size
-                f.seek(block_pos)
-                f.write(block_data)
+    worker_count = worker_count or default_worker_count
+    source_fd = os.open(reflink_source, os.O_RDONLY) if reflink_source else None
+    try:
+        fd = os.open(file, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            # Only the changed blocks are written, so there is no point in readahead
+            advise(fd, 'POSIX_FADV_RANDOM')
+            if is_splice_possible(block_input_stream):
+                input_fd = block_input_stream.fileno()
+                for command, block_pos, block_size in read_data_stream(partial(read_fd_exactly, input_fd)):
+                    if command == b'copy':
+                        copy_block(source_fd, fd, block_pos, block_size)
+                    else:
+                        splice_exactly(input_fd, fd, block_pos, block_size)
+            else:
+                write_blocks(fd, block_input_stream, worker_count, source_fd)
+        finally:
+            os.close(fd)
+    finally:
+        if source_fd is not None:
+            os.close(source_fd)
+
+
+def write_blocks(fd, block_input_stream, worker_count, source_fd=None):
+    '''
+    Read blocks from block_input_stream and write them to fd in worker threads.
+
+    The order of the writes does not matter, because every block has its own position.
+    '''
+    read = block_input_stream.read
+
+    def read_blocks():
+        for command, block_pos, block_size in read_data_stream(read):
+            if command == b'copy':
+                yield block_pos, block_size, None
             else:
-                raise Exception(f'Unknown command received: {command!r}')
+                block_data = read(block_size)
+                assert len(block_data) == block_size
+                yield block_pos, block_size, block_data
+
+    def write_block(block_pos, block_size, block_data):
+        # Will run in multiple threads
+        if block_data is None:
+            copy_block(source_fd, fd, block_pos, block_size)
+        else:
+            pwrite_exactly(fd, block_data, block_pos)
+
+    with ThreadPoolExecutor(worker_count) as executor:
+        for _ in map_ordered(executor, write_block, read_blocks(), worker_count * 3):
+            pass
+
+
+def read_data_stream(read):
+    '''
+    Parse the stream produced by do_retrieve using the given read function.
+
+    Yields tuples (command, block_pos, block_size) for every "data" and "copy"
+    command. For "data" the caller must consume the block_size bytes of block
+    data before getting the next item.
+    '''
+    while True:
+        command = read(4)
+        if not command:
+            break
+        if command == b'done':
+            break
+        elif command == b'data':
+            fields = read(data_fields.size)
+            assert len(fields) == data_fields.size
+            yield (command, *data_fields.unpack(fields))
+        elif command == b'copy':
+            fields = read(copy_fields.size)
+            assert len(fields) == copy_fields.size
+            yield (command, *copy_fields.unpack(fields))
+        else:
+            raise Exception(f'Unknown command received: {command!r}')
+
+
+def pwrite_exactly(fd, data, pos):
+    '''
+    Write all data to file position pos without using the file descriptor position.
+    '''
+    view = memoryview(data)
+    while view:
+        n = os.pwrite(fd, view, pos)
+        view = view[n:]
+        pos += n
+
+
+# os.copy_file_range errors meaning that it cannot be used for the given files
+copy_file_range_unsupported_errnos = {errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOSYS}
+
+
+def copy_block(source_fd, fd, pos, size):
+    '''
+    Copy size bytes at position pos from source_fd to fd at the same position.
+
+    os.copy_file_range lets the filesystem share the extents (reflink)
+    or at least copy the data without passing them through Python.
+    Where it is not available or not supported for these files (different
+    filesystems, block devices), the data are copied using pread and pwrite.
+    '''
+    if source_fd is None:
+        raise Exception('Command "copy" received, but no source file was given (use save --reflink SOURCE)')
+    use_copy_file_range = hasattr(os, 'copy_file_range')
+    while size:
+        n = None
+        if use_copy_file_range:
+            try:
+                n = os.copy_file_range(source_fd, fd, size, pos, pos)
+            except OSError as e:
+                if e.errno not in copy_file_range_unsupported_errnos:
+                    raise
+                logger.debug('copy_file_range not possible, using pread/pwrite: %r', e)
+                use_copy_file_range = False
+        if n is None:
+            n = os.pwrite(fd, os.pread(source_fd, size, pos), pos)
+        if not n:
+            raise Exception('Unexpected end of source file')
+        pos += n
+        size -= n
+
+
+def is_splice_possible(input_stream):
+    if not hasattr(os, 'splice'):
+        return False
+    try:
+        return stat.S_ISFIFO(os.fstat(input_stream.fileno()).st_mode)
+    except (AttributeError, OSError, ValueError):
+        # for example io.BytesIO has no file descriptor
+        return False
+
+
+def read_fd_exactly(fd, size):
+    '''
+    Read size bytes from file descriptor (less only at the end of file).
+    '''
+    data = os.read(fd, size)
+    while data and len(data) < size:
+        chunk = os.read(fd, size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def splice_exactly(input_fd, output_fd, output_pos, size):
+    '''
+    Move size bytes from pipe input_fd to file output_fd at position output_pos.
+    '''
+    while size:
+        n = os.splice(input_fd, output_fd, size, offset_dst=output_pos)
+        if not n:
+            raise Exception('Unexpected end of input')
+        output_pos += n
+        size -= n
 
 
 if __name__ == "__main__":
@@ -0,0 +1,201 @@
+from contextlib import ExitStack
+import fcntl
+from importlib.util import module_from_spec, spec_from_file_location
+from io import BytesIO
+import os
+from pathlib import Path
+from pytest import fixture, mark
+import shutil
+from subprocess import CalledProcessError, Popen, PIPE, DEVNULL
+import sys
+import tempfile
+
+
+blockcopy_path = Path(__file__).resolve().parent.parent / 'blockcopy.py'
+
+
+# Directory created for tmp_path on tmpfs, removed at the end of the session
+tmpfs_basetemp = None
+
+
+def pytest_addoption(parser, pluginmanager):
+    parser.addoption('--quick', action='store_true', help='skip the tests marked as slow')
+    if not pluginmanager.hasplugin('timeout'):
+        # Without pytest-timeout the timeout in pyproject.toml is ignored instead of causing a warning
+        parser.addini('timeout', 'test timeout in seconds (used by pytest-timeout)')
+
+
+def pytest_collection_modifyitems(config, items):
+    skip_slow = mark.skip(reason='slow test skipped because of --quick')
+    skip_bench = mark.skip(reason='benchmarks run only with -m bench')
+    for item in items:
+        if 'slow' in item.keywords and config.getoption('--quick'):
+            item.add_marker(skip_slow)
+        if 'bench' in item.keywords and 'bench' not in config.option.markexpr:
+            item.add_marker(skip_bench)
+
+
+def pytest_configure(config):
+    '''
+    Put tmp_path on tmpfs (/dev/shm, or directory in env. variable BLOCKCOPY_TEST_TMP;
+    empty value disables it) so that the tests measure blockcopy and not the disk.
+    Not done if --basetemp is given (that includes pytest-xdist workers).
+    '''
+    global tmpfs_basetemp
+    config.addinivalue_line('markers', 'slow: test with large files, skipped with --quick')
+    config.addinivalue_line('markers', 'bench: benchmark (pytest-benchmark), run only with -m bench')
+    if config.option.basetemp is not None:
+        return
+    base = os.environ.get('BLOCKCOPY_TEST_TMP', '/dev/shm')
+    if base and os.path.isdir(base) and os.access(base, os.W_OK):
+        tmpfs_basetemp = tempfile.mkdtemp(prefix='blockcopy-tests-', dir=base)
+        config.option.basetemp = tmpfs_basetemp
+
+
+def pytest_unconfigure(config):
+    if tmpfs_basetemp is not None:
+        shutil.rmtree(tmpfs_basetemp, ignore_errors=True)
+
+
+@fixture(scope='session')
+def script_path():
+    return blockcopy_path
+
+
+@fixture(scope='session')
+def test_content():
+    return b'Test content.' * 102400
+
+
+@fixture(scope='session')
+def content_template(tmp_path_factory):
+    '''
+    13 MB file with b'Test content.' repeated, for creating the large test files
+    using copy_template() instead of building them in memory.
+    '''
+    path = tmp_path_factory.mktemp('template') / 'content'
+    path.write_bytes(b'Test content.' * 1024000)
+    return path
+
+
+@fixture(scope='session')
+def test_files(tmp_path_factory, test_content):
+    '''
+    Source file with test_content and a destination file that differs from
+    it after the first 500000 bytes, created once for the whole session.
+    '''
+    files_path = tmp_path_factory.mktemp('test_files')
+    src_path = files_path / 'src_file'
+    src_path.write_bytes(test_content)
+    dst_path = files_path / 'dst_file'
+    dst_path.write_bytes(test_content[:500000] + b'-' * (len(test_content) - 500000))
+    return src_path, dst_path
+
+
+@fixture
+def src_path(test_files):
+    '''
+    Source file with test_content - shared by all tests, must not be modified.
+    '''
+    return test_files[0]
+
+
+@fixture
+def dst_path(tmp_path, test_files):
+    '''
+    Copy of the destination file from test_files for the test to modify.
+    '''
+    path = tmp_path / 'dst_file'
+    shutil.copyfile(test_files[1], path)
+    return path
+
+
+@fixture(scope='session')
+def blockcopy():
+    '''
+    The blockcopy.py script imported as a module, for running its commands in-process.
+    '''
+    if 'blockcopy' not in sys.modules:
+        spec = spec_from_file_location('blockcopy', blockcopy_path)
+        module = module_from_spec(spec)
+        # Registered before exec so that worker processes (--processes) can unpickle its functions
+        sys.modules['blockcopy'] = module
+        spec.loader.exec_module(module)
+    return sys.modules['blockcopy']
+
+
+@fixture
+def copy_in_process(blockcopy):
+    '''
+    Return function that runs checksum, retrieve and save in this process,
+    passing the streams between them in BytesIO.
+
+    Much faster than starting three Python processes for every test case;
+    the command line and the pipes are tested by the tests running the script.
+    '''
+    def copy(src_path, dst_path, checksum_options=None, retrieve_options=None, save_options=None):
+        hash_stream = BytesIO()
+        blockcopy.do_checksum(str(dst_path), hash_stream, **(checksum_options or {}))
+        hash_stream.seek(0)
+        block_stream = BytesIO()
+        blockcopy.do_retrieve(str(src_path), hash_stream, block_stream, **(retrieve_options or {}))
+        block_stream.seek(0)
+        blockcopy.do_save(str(dst_path), block_stream, **(save_options or {}))
+        return hash_stream.getvalue(), block_stream.getvalue()
+
+    return copy
+
+
+@fixture
+def copy_with_script(script_path):
+    '''
+    Return function that runs checksum, retrieve and save as separate processes
+    connected by pipes, like they are used in practice.
+    '''
+    def copy(src_path, dst_path, checksum_args=None, retrieve_args=None, save_args=None):
+        run_chain(
+            [script_path, 'checksum', *(checksum_args or ()), str(dst_path)],
+            [script_path, 'retrieve', *(retrieve_args or ()), str(src_path)],
+            [script_path, 'save', *(save_args or ()), str(dst_path)])
+
+    return copy
+
+
+def enlarge_pipe(f, size=1 << 20):
+    '''
+    Make the pipe buffer larger than the default 64 KiB, so that the processes
+    in the chain are woken up less often. Silently ignored where not possible.
+    '''
+    try:
+        fcntl.fcntl(f.fileno(), getattr(fcntl, 'F_SETPIPE_SZ', 1031), size)
+    except OSError:
+        # for example EPERM when size is above /proc/sys/fs/pipe-max-size
+        pass
+
+
+def run_chain(*cmds):
+    '''
+    Run the commands connected by pipes like a shell pipeline and wait for all of them.
+    Raises CalledProcessError for the last command that failed (like pipefail in bash) -
+    a failure usually kills the processes before it by SIGPIPE.
+
+    Our copies of the pipe ends are closed as soon as they are passed to the next
+    process, so that when a process exits, its neighbours get EOF or EPIPE
+    instead of waiting forever.
+    '''
+    with ExitStack() as stack:
+        processes = []
+        stdin = DEVNULL
+        for n, cmd in enumerate(cmds, start=1):
+            p = stack.enter_context(Popen(cmd, stdin=stdin, stdout=PIPE if n < len(cmds) else None))
+            if stdin is not DEVNULL:
+                stdin.close()
+            if p.stdout is not None:
+                enlarge_pipe(p.stdout)
+            stdin = p.stdout
+            processes.append(p)
+        for p in processes:
+            p.wait()
+    for p in reversed(processes):
+        if p.returncode:
+            raise CalledProcessError(p.returncode, p.args)
@@ -1,13 +1,77 @@
-from contextlib import ExitStack
-from pathlib import Path
-from pytest import fixture
+from importlib.util import find_spec
+from io import BytesIO
+import errno
+import json
+import mmap
+import os
+from pytest import mark, param, raises, skip
+import shutil
 import subprocess
-from subprocess import Popen, PIPE, DEVNULL
+from subprocess import PIPE, DEVNULL
+import tempfile
+import time
 
 
-@fixture
-def script_path():
-    return Path(__file__).resolve().parent.parent / 'blockcopy.py'
+def copy_template(template_path, path, size):
+    '''
+    Create file with the first size bytes of template_path.
+    The data are copied by the kernel (or shared, on btrfs or XFS) if possible.
+    '''
+    with open(template_path, 'rb') as f_src, open(path, 'wb') as f:
+        pos = 0
+        while pos < size:
+            try:
+                n = os.copy_file_range(f_src.fileno(), f.fileno(), size - pos, pos, pos)
+            except (AttributeError, OSError):
+                n = os.pwrite(f.fileno(), os.pread(f_src.fileno(), size - pos, pos), pos)
+            assert n, 'Template is too short'
+            pos += n
+
+
+def prepare_dst(path, size):
+    '''
+    Create destination file of the given size that differs from the test content
+    in every block - without writing the whole file.
+    '''
+    with open(path, 'wb') as f:
+        f.write(b'-' * min(size, 4096))
+        if hasattr(os, 'posix_fallocate') and size:
+            os.posix_fallocate(f.fileno(), 0, size)
+        f.truncate(size)
+
+
+# Streams produced for a 12-byte destination file b'Hello Dirt!!' and source file b'Hello World!'
+EXPECTED_CHECKSUM_HELLO_DIRT = (
+    b'algo\x06sha256'
+    b'hash\x00\x00\x00\x0c'
+    b'MxN\xe4\xcd\x9d6\xc3\xeb/\xe6\xf6p\x92I\xb8\x07\x17\x91H9\x8eW|:\x0e\x0c\xfd\x7f\x83\x8aw'
+    b'rest\x00\x00\x00\x00\x00\x00\x00\x0c'
+    b'done')
+EXPECTED_RETRIEVE_HELLO = b'data\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x0cHello World!done'
+
+
+def assert_files_equal(expected_path, path, chunk_size=1 << 20):
+    '''
+    Compare content of two files via mmap, chunk by chunk, without reading them into memory.
+    '''
+    with open(expected_path, 'rb') as f_expected, open(path, 'rb') as f:
+        size = os.fstat(f_expected.fileno()).st_size
+        assert os.fstat(f.fileno()).st_size == size, f'File size differs from {size} bytes'
+        if not size:
+            return
+        with mmap.mmap(f_expected.fileno(), 0, access=mmap.ACCESS_READ) as m_expected, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            for pos in range(0, size, chunk_size):
+                assert m[pos:pos + chunk_size] == m_expected[pos:pos + chunk_size], \
+                    f'File content differs at position {pos}'
+
+
+def cached_size(path):
+    '''
+    Return number of bytes of the file that are in the page cache (using fincore from util-linux).
+    '''
+    out = subprocess.check_output(['fincore', '--bytes', '--noheadings', '--output', 'RES', str(path)])
+    return int(out)
 
 
 def test_help(script_path):
@@ -15,23 +79,295 @@ def test_help(script_path):
     assert subprocess.run(cmd, stdout=DEVNULL, stderr=DEVNULL).returncode == 0
 
 
-def test_copy(tmp_path, script_path):
-    test_content = b'Test content.' * 1024000
+@mark.parametrize('argv', [['--help'], ['checksum', '--help'], ['retrieve', '--help'], ['save', '--help']])
+def test_help_in_process(blockcopy, capsys, argv):
+    with raises(SystemExit) as exc_info:
+        blockcopy.main(argv)
+    assert exc_info.value.code == 0
+    assert 'usage:' in capsys.readouterr().out
+
+
+@mark.parametrize('size', [4096, (1 << 20) + 1, 5 << 20, param(13 * 1024000, marks=mark.slow)])
+def test_copy(tmp_path, content_template, copy_with_script, size):
+    # Runs the script itself, so the streams go through pipes (splice, sendfile)
+    src_path = tmp_path / 'src_file'
+    copy_template(content_template, src_path, size)
+    dst_path = tmp_path / 'dst_file'
+    prepare_dst(dst_path, size)
+
+    copy_with_script(src_path, dst_path)
+
+    assert_files_equal(src_path, dst_path)
+
+
+@mark.parametrize('hash_name', [
+    'sha3_512', 'sha256', 'blake2b', 'crc32+sha256',
+    param('blake3', marks=mark.skipif(find_spec('blake3') is None, reason='blake3 not installed')),
+    param('xxh3_128', marks=mark.skipif(find_spec('xxhash') is None, reason='xxhash not installed')),
+])
+def test_copy_with_hash_algorithm(src_path, dst_path, copy_in_process, hash_name):
+    copy_in_process(src_path, dst_path, checksum_options={'hash_name': hash_name})
+    assert_files_equal(src_path, dst_path)
+
+
+@mark.parametrize('options', [
+    {'use_processes': True},
+    {'worker_count': 3},
+    {'drop_cache': True},
+    {'use_processes': True, 'drop_cache': True},
+])
+def test_copy_with_options(src_path, dst_path, copy_in_process, options):
+    copy_in_process(src_path, dst_path, checksum_options=options, retrieve_options=options)
+    assert_files_equal(src_path, dst_path)
+
+
+@mark.skipif(shutil.which('fincore') is None, reason='fincore not installed')
+@mark.skipif(not hasattr(os, 'posix_fadvise'), reason='posix_fadvise not available')
+@mark.parametrize('use_processes', [False, True])
+def test_drop_cache(blockcopy, use_processes):
+    # Not in tmp_path - tmpfs pages cannot be dropped from the page cache
+    with tempfile.TemporaryDirectory(prefix='blockcopy-test-') as tmp_dir:
+        path = os.path.join(tmp_dir, 'file')
+        with open(path, 'wb') as f:
+            f.write(os.urandom(8 << 20))
+            # Dirty pages are not dropped by POSIX_FADV_DONTNEED
+            os.fsync(f.fileno())
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        if cached_size(path) != 0:
+            skip('page cache cannot be dropped on this file system')
+
+        def read_whole_file():
+            with open(path, 'rb') as f:
+                while f.read(1 << 20):
+                    pass
+            assert cached_size(path) > 0
+
+        read_whole_file()
+        hash_stream = BytesIO()
+        blockcopy.do_checksum(path, hash_stream, use_processes=use_processes, drop_cache=True)
+        assert cached_size(path) == 0
+
+        # Every block differs, so retrieve reads them all in the main process too
+        read_whole_file()
+        hash_stream = BytesIO()
+        zero_path = os.path.join(tmp_dir, 'zero')
+        with open(zero_path, 'wb') as f:
+            f.truncate(8 << 20)
+        blockcopy.do_checksum(zero_path, hash_stream)
+        hash_stream.seek(0)
+        block_stream = BytesIO()
+        blockcopy.do_retrieve(path, hash_stream, block_stream, use_processes=use_processes, drop_cache=True)
+        assert len(block_stream.getvalue()) > 8 << 20
+        assert cached_size(path) == 0
+
+
+def test_copy_with_command_line_options(tmp_path, src_path, dst_path, copy_with_script):
+    # The in-process tests call do_* directly, this checks that main() passes the options through
+    cache_path = tmp_path / 'hash_cache'
+    copy_with_script(
+        src_path, dst_path,
+        checksum_args=[
+            '--hash', 'crc32+sha256', '--block-size', '64K', '--digest-bytes', '16',
+            '--hash-cache', str(cache_path), '--workers', '2', '--processes', '--drop-cache'],
+        retrieve_args=['--workers', '2', '--processes', '--drop-cache'],
+        save_args=['--workers', '2'])
+    assert_files_equal(src_path, dst_path)
+
+
+def test_retrieve_fails_on_unknown_command(src_path, script_path):
+    cmd = [script_path, 'retrieve', str(src_path)]
+    p = subprocess.run(cmd, input=b'algo\x06sha256xxxx', stdout=PIPE, stderr=PIPE, timeout=30)
+    assert p.returncode != 0
+    assert b'Unknown command received' in p.stderr
+
+
+def test_retrieve_to_appended_file(tmp_path, src_path, dst_path, blockcopy):
+    # Like "blockcopy.py retrieve src < hashes >> blocks" - sendfile does not work with O_APPEND
+    hash_stream = BytesIO()
+    blockcopy.do_checksum(str(dst_path), hash_stream)
+    hash_stream.seek(0)
+    blocks_path = tmp_path / 'blocks'
+    with blocks_path.open('ab') as f:
+        blockcopy.do_retrieve(str(src_path), hash_stream, f)
+    with blocks_path.open('rb') as f:
+        blockcopy.do_save(str(dst_path), f)
+    assert_files_equal(src_path, dst_path)
+
+
+def test_save_from_file(src_path, dst_path, copy_in_process):
+    # BytesIO is not a pipe, so the blocks are written by the write workers instead of splice
+    copy_in_process(src_path, dst_path, save_options={'worker_count': 3})
+    assert_files_equal(src_path, dst_path)
+
+
+@mark.parametrize('dst_content', [None, b'', b'Test content.' * 1000], ids=['missing', 'empty', 'smaller'])
+def test_copy_to_missing_or_smaller_file(tmp_path, src_path, copy_in_process, dst_content):
+    dst_path = tmp_path / 'dst_file'
+    if dst_content is not None:
+        dst_path.write_bytes(dst_content)
+    copy_in_process(src_path, dst_path)
+    assert_files_equal(src_path, dst_path)
+
+
+def test_copy_tiny_streams(tmp_path, copy_in_process):
+    # The exact stream format is checked, so that protocol changes do not go unnoticed
     src_path = tmp_path / 'src_file'
-    src_path.write_bytes(test_content)
+    src_path.write_bytes(b'Hello World!')
     dst_path = tmp_path / 'dst_file'
-    dst_path.write_bytes(b'-' * len(test_content))
+    dst_path.write_bytes(b'Hello Dirt!!')
+    hash_stream, block_stream = copy_in_process(src_path, dst_path)
+    assert hash_stream == EXPECTED_CHECKSUM_HELLO_DIRT
+    assert block_stream == EXPECTED_RETRIEVE_HELLO
+    assert dst_path.read_bytes() == b'Hello World!'
+
+
+def test_find_changed_blocks_positions(blockcopy):
+    # Blocks of different sizes (like the last block of a file), batch not at the file start
+    hash_factory = blockcopy.get_hash_factory('sha256')
+    data = b'aaabbbbbcc'
+    destination_hashes = [hash_factory(b'aaa').digest(), hash_factory(b'XXXXX').digest(), hash_factory(b'XX').digest()]
+    changed = blockcopy.find_changed_blocks(hash_factory, memoryview(data), 1000, [3, 5, 2], destination_hashes)
+    assert [(pos, bytes(block_data)) for pos, block_data in changed] == [(1003, b'bbbbb'), (1008, b'cc')]
+    changed = blockcopy.find_changed_blocks(hash_factory, memoryview(data), 1000, [3, 5, 2], [None, None, None])
+    assert [(pos, bytes(block_data)) for pos, block_data in changed] == [(1000, b'aaa'), (1003, b'bbbbb'), (1008, b'cc')]
+
+
+def test_checksum_hash_cache(tmp_path, dst_path, blockcopy, monkeypatch):
+    cache_path = tmp_path / 'hash_cache'
+
+    def checksum():
+        output = BytesIO()
+        blockcopy.do_checksum(str(dst_path), output, hash_cache_path=str(cache_path))
+        return output.getvalue()
+
+    # files modified in the last few seconds are not cached
+    output1 = checksum()
+    assert not cache_path.exists()
+
+    # instead of waiting for the file to get older
+    monkeypatch.setattr(blockcopy, 'hash_cache_min_age', 0)
+    output2 = checksum()
+    assert output2 == output1
+    cache_lines = cache_path.read_bytes().split(b'\n', 1)
+    assert json.loads(cache_lines[0])['size'] == dst_path.stat().st_size
+    assert cache_lines[1] in output1
+
+    # the hashes are taken from the cache
+    cache_path.write_bytes(cache_lines[0] + b'\n')
+    output3 = checksum()
+    assert output3 == output1.replace(cache_lines[1], b'')
+
+
+@mark.parametrize('restore_mtime', [False, True])
+def test_checksum_hash_cache_invalidated(tmp_path, src_path, dst_path, blockcopy, copy_in_process, monkeypatch, restore_mtime):
+    cache_path = tmp_path / 'hash_cache'
+    monkeypatch.setattr(blockcopy, 'hash_cache_min_age', 0)
+    old_mtime = time.time() - 3600
+    os.utime(dst_path, (old_mtime, old_mtime))
+
+    def checksum(**kwargs):
+        output = BytesIO()
+        blockcopy.do_checksum(str(dst_path), output, **kwargs)
+        return output.getvalue()
+
+    output1 = checksum(hash_cache_path=str(cache_path))
+    assert cache_path.exists()
+
+    if restore_mtime:
+        # Only ctime can tell that the file has changed; it has a coarse resolution,
+        # so wait until it moves on like it would between two runs in practice
+        cached_ctime = dst_path.stat().st_ctime_ns
+        while dst_path.stat().st_ctime_ns == cached_ctime:
+            os.utime(dst_path, (old_mtime, old_mtime))
+    # Same size, different content
+    with dst_path.open('r+b') as f:
+        f.write(b'changed')
+    if restore_mtime:
+        # like rsync -t or touch -r
+        os.utime(dst_path, (old_mtime, old_mtime))
+
+    output2 = checksum(hash_cache_path=str(cache_path))
+    assert output2 != output1
+    assert output2 == checksum()
+
+    copy_in_process(src_path, dst_path, checksum_options={'hash_cache_path': str(cache_path)})
+    assert_files_equal(src_path, dst_path)
+
+
+@mark.parametrize('block_size', [4 << 10, 1 << 20, 3 << 20])
+def test_copy_with_block_size(tmp_path, content_template, copy_in_process, block_size):
+    size = 13 * 402400
+    src_path = tmp_path / 'src_file'
+    copy_template(content_template, src_path, size)
+    dst_path = tmp_path / 'dst_file'
+    # Same first 500000 bytes, zeros after that
+    copy_template(content_template, dst_path, 500000)
+    os.truncate(dst_path, size)
+    copy_in_process(src_path, dst_path, checksum_options={'block_size': block_size})
+    assert_files_equal(src_path, dst_path)
+
+
+@mark.parametrize('value', ['0', '-1', '65M', '4096M', 'xK'])
+def test_checksum_rejects_invalid_block_size(blockcopy, capsys, dst_path, value):
+    with raises(SystemExit) as exc_info:
+        blockcopy.main(['checksum', '--block-size', value, str(dst_path)])
+    assert exc_info.value.code == 2
+    assert 'argument --block-size' in capsys.readouterr().err
+
+
+@mark.parametrize('command', ['checksum', 'retrieve', 'save'])
+@mark.parametrize('value', ['0', '-1', 'x'])
+def test_rejects_invalid_workers(blockcopy, capsys, dst_path, command, value):
+    with raises(SystemExit) as exc_info:
+        blockcopy.main([command, '--workers', value, str(dst_path)])
+    assert exc_info.value.code == 2
+    assert 'argument --workers' in capsys.readouterr().err
+
+
+@mark.parametrize('checksum_options', [{'digest_size': 16}, {'digest_size': 8, 'hash_name': 'crc32+sha256'}])
+def test_copy_with_digest_bytes(src_path, dst_path, copy_in_process, checksum_options):
+    copy_in_process(src_path, dst_path, checksum_options=checksum_options)
+    assert_files_equal(src_path, dst_path)
+
+
+def test_crc32_pre_check_with_digest_bytes(blockcopy):
+    hash_factory = blockcopy.get_hash_factory('crc32+sha256', 8)
+    destination_hashes = [hash_factory(b'same').digest(), hash_factory(b'old').digest()]
+    block_hashes = blockcopy.hash_blocks_to_compare(hash_factory, [b'same', b'new'], destination_hashes)
+    assert block_hashes[0] == destination_hashes[0]
+    # only crc32 is computed for the changed block
+    assert len(block_hashes[1]) == blockcopy.Crc32PrefixedHash.crc_size
+
+
+@mark.parametrize('digest_bytes', ['4', '33'])
+def test_checksum_rejects_invalid_digest_bytes(blockcopy, capsys, dst_path, digest_bytes):
+    with raises(SystemExit) as exc_info:
+        blockcopy.main(['checksum', '--digest-bytes', digest_bytes, str(dst_path)])
+    assert exc_info.value.code == 2
+    assert '--digest-bytes for sha256 must be between 8 and 32' in capsys.readouterr().err
+
+
+def test_copy_with_reflink(src_path, dst_path, copy_in_process):
+    _, block_stream = copy_in_process(
+        src_path, dst_path, retrieve_options={'reflink': True}, save_options={'reflink_source': str(src_path)})
+    # only positions are sent, not the data
+    assert len(block_stream) < 1000
+    assert_files_equal(src_path, dst_path)
+
+
+@mark.parametrize('error', ['EXDEV', 'EINVAL', 'EOPNOTSUPP', 'ENOSYS'])
+def test_copy_with_reflink_fallback(src_path, dst_path, copy_in_process, monkeypatch, error):
+    # For example source and destination on different filesystems (EXDEV) or block devices (EINVAL)
+    def copy_file_range(*args):
+        raise OSError(getattr(errno, error), os.strerror(getattr(errno, error)))
+
+    monkeypatch.setattr(os, 'copy_file_range', copy_file_range, raising=False)
+    copy_in_process(
+        src_path, dst_path, retrieve_options={'reflink': True}, save_options={'reflink_source': str(src_path)})
+    assert_files_equal(src_path, dst_path)
 
-    cmd1 = [script_path, 'checksum', str(dst_path)]
-    cmd2 = [script_path, 'retrieve', str(src_path)]
-    cmd3 = [script_path, 'save', str(dst_path)]
 
-    with ExitStack() as stack:
-        p1 = stack.enter_context(Popen(cmd1, stdin=DEVNULL, stdout=PIPE))
-        p2 = stack.enter_context(Popen(cmd2, stdin=p1.stdout, stdout=PIPE))
-        p3 = stack.enter_context(Popen(cmd3, stdin=p2.stdout))
-        assert p1.wait() == 0
-        assert p2.wait() == 0
-        assert p3.wait() == 0
+def test_copy_with_reflink_through_pipes(src_path, dst_path, copy_with_script):
+    copy_with_script(src_path, dst_path, retrieve_args=['--reflink'], save_args=['--reflink', str(src_path)])
 
-    assert dst_path.read_bytes() == test_content
+    assert_files_equal(src_path, dst_path)
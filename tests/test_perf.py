@@ -0,0 +1,35 @@
+from io import BytesIO
+import os
+from pytest import importorskip, mark
+
+
+importorskip('pytest_benchmark')
+
+pytestmark = mark.bench
+
+
+@mark.benchmark(group='checksum')
+@mark.parametrize('hash_name', ['sha256', 'crc32+sha256'])
+def test_checksum_throughput(benchmark, tmp_path, blockcopy, hash_name):
+    file_path = tmp_path / 'file'
+    file_path.write_bytes(os.urandom(64 << 20))
+
+    def checksum():
+        blockcopy.do_checksum(str(file_path), BytesIO(), hash_name=hash_name)
+
+    benchmark.pedantic(checksum, rounds=5, warmup_rounds=1)
+
+
+@mark.benchmark(group='retrieve')
+def test_retrieve_throughput(benchmark, tmp_path, blockcopy):
+    # Both files are the same, so retrieve only hashes and compares
+    file_path = tmp_path / 'file'
+    file_path.write_bytes(os.urandom(64 << 20))
+    hash_stream = BytesIO()
+    blockcopy.do_checksum(str(file_path), hash_stream)
+
+    def retrieve():
+        hash_stream.seek(0)
+        blockcopy.do_retrieve(str(file_path), hash_stream, BytesIO())
+
+    benchmark.pedantic(retrieve, rounds=5, warmup_rounds=1)